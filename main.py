@@ -1,22 +1,44 @@
 #!/bin/env python3
+import gzip
 import re
 import unicodedata
+from asyncio import Semaphore, TimeoutError, create_task, gather, get_running_loop, run, sleep
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import timedelta
+from functools import lru_cache
+from html import unescape
 from os import remove
-from os.path import splitext
 from pathlib import Path
-from typing import List
+from shutil import copyfileobj
+from typing import Any, Awaitable, Callable, Coroutine, List, Optional, Tuple
 from zipfile import ZipFile, BadZipFile
 
-from bs4 import BeautifulSoup, Tag
+from aiohttp import ClientError, ClientResponseError, ClientSession, ClientTimeout, TCPConnector
+from requests import PreparedRequest, Response
+from selectolax.lexbor import LexborHTMLParser
 from spoofbot import Firefox, Browser
 from spoofbot.adapter import FileCacheAdapter
-from urllib3.util import Url, parse_url
+from urllib3.util import Retry, Url
 
 MAIN_SITE = 'papers.nips.cc'
+DOWNLOAD_RETRIES = 3
+DOWNLOAD_BACKOFF = 0.5
+GZIP_MAGIC = b'\x1f\x8b'
+HTML_TAGS = re.compile(r'</?[A-Za-z][^>]*>')
+BUTTON_ATTRIBUTES = {
+    'AuthorFeedback »': 'author_feedback_url',
+    'Bibtex »': 'bibtex_url',
+    'MetaReview »': 'meta_review_url',
+    'Paper »': 'paper_url',
+    'Review »': 'review_url',
+    'Supplemental »': 'supplemental_url',
+}
+SLUG_INVALID_CHARS = re.compile(r'[^\w\s-]')
+SLUG_SEPARATORS = re.compile(r'[-\s]+')
 
 
 class PaperEntry:
+    __slots__ = ('url', 'title', 'authors')
     url: Url
     title: str
     authors: List[str]
@@ -31,17 +53,19 @@ class PaperEntry:
 
 
 class Paper:
+    __slots__ = ('paper_entry', 'abstract', 'author_feedback_url', 'bibtex_url', 'meta_review_url', 'paper_url',
+                 'review_url', 'supplemental_url')
     paper_entry: PaperEntry
     abstract: str
-    author_feedback_url: Url
-    bibtex_url: Url
-    meta_review_url: Url
-    paper_url: Url
-    review_url: Url
-    supplemental_url: Url
-
-    def __init__(self, paper_entry: PaperEntry, abstract: Url, author_feedback_url: Url, bibtex_url: Url,
-                 meta_review_url: Url, paper_url: Url, review_url: Url, supplemental_url: Url):
+    author_feedback_url: Optional[str]
+    bibtex_url: str
+    meta_review_url: str
+    paper_url: str
+    review_url: str
+    supplemental_url: Optional[str]
+
+    def __init__(self, paper_entry: PaperEntry, abstract: str, author_feedback_url: Optional[str], bibtex_url: str,
+                 meta_review_url: str, paper_url: str, review_url: str, supplemental_url: Optional[str]):
         self.paper_entry = paper_entry
         self.abstract = abstract
         self.author_feedback_url = author_feedback_url
@@ -55,56 +79,71 @@ class Paper:
         return str(self.paper_entry)
 
 
+class GzipFileCacheAdapter(FileCacheAdapter):
+    """
+    File cache adapter which stores the cached response bodies gzip-compressed.
+    Responses cached uncompressed by earlier runs are still served as they are.
+    """
+
+    def _save(self, content: bytes, path: Path) -> bool:
+        return super(GzipFileCacheAdapter, self)._save(gzip.compress(content), path)
+
+    def _get_response_if_hit(self, request: PreparedRequest) -> Optional[Response]:
+        response = super(GzipFileCacheAdapter, self)._get_response_if_hit(request)
+        if response is not None:
+            content = response.raw.read()
+            response._content = gzip.decompress(content) if content[:2] == GZIP_MAGIC else content
+        return response
+
+
 def get_paper_entries(browser: Browser, year: int) -> List[PaperEntry]:
-    main_site = BeautifulSoup(browser.navigate(f"https://{MAIN_SITE}/paper/{year}").content, features="html5lib")
-    paper_entries = []
-    li: Tag
-    for li in main_site.select('.col > ul > li'):
-        a = li.select_one('a')
-        i = li.select_one('i')
-        paper_entries.append(PaperEntry(a.get('href'), a.text, i.text.split(', ')))
-    return paper_entries
+    main_site = LexborHTMLParser(browser.navigate(f"https://{MAIN_SITE}/paper/{year}").content)
+    anchors = main_site.css('.col > ul > li > a')
+    italics = main_site.css('.col > ul > li > i')
+    assert (len(anchors) == len(italics))
+    return [PaperEntry(a.attributes['href'], a.text(), i.text().split(', ')) for a, i in zip(anchors, italics)]
 
 
 def get_paper(browser: Browser, paper_entry: PaperEntry) -> Paper:
-    paper_site = BeautifulSoup(browser.navigate(paper_entry.url.url).content, features="html5lib")
-    url = paper_entry.url
-    author_feedback_url = None
-    bibtex_url = None
-    meta_review_url = None
-    paper_url = None
-    review_url = None
-    supplemental_url = None
-    for a in paper_site.select('a.btn'):
-        if a.text == 'AuthorFeedback »':
-            author_feedback_url = parse_url(f"{url.scheme}://{url.host}{a.get('href')}")
-        elif a.text == 'Bibtex »':
-            bibtex_url = parse_url(f"{url.scheme}://{url.host}{a.get('href')}")
-        elif a.text == 'MetaReview »':
-            meta_review_url = parse_url(f"{url.scheme}://{url.host}{a.get('href')}")
-        elif a.text == 'Paper »':
-            paper_url = parse_url(f"{url.scheme}://{url.host}{a.get('href')}")
-        elif a.text == 'Review »':
-            review_url = parse_url(f"{url.scheme}://{url.host}{a.get('href')}")
-        elif a.text == 'Supplemental »':
-            supplemental_url = parse_url(f"{url.scheme}://{url.host}{a.get('href')}")
-        else:
-            raise Exception(f"Failed to bin link for '{a.text}': {a.get('href')}")
+    return parse_paper(paper_entry, browser.navigate(paper_entry.url.url).content)
+
+
+def parse_paper(paper_entry: PaperEntry, content: bytes) -> Paper:
+    paper_site = LexborHTMLParser(content)
+    base = f"{paper_entry.url.scheme}://{paper_entry.url.host}"
+    urls = dict.fromkeys(BUTTON_ATTRIBUTES.values())
+    for a in paper_site.css('a.btn'):
+        attribute = BUTTON_ATTRIBUTES.get(a.text())
+        if attribute is None:
+            raise Exception(f"Failed to bin link for '{a.text()}': {a.attributes['href']}")
+        urls[attribute] = base + a.attributes['href']
     return Paper(
         paper_entry,
-        BeautifulSoup(  # The abstract is uninterpreted html code
-            paper_site.select_one('.col > p:nth-child(8)').text,
-            features="html5lib"
-        ).text.strip(),
-        author_feedback_url,
-        bibtex_url,
-        meta_review_url,
-        paper_url,
-        review_url,
-        supplemental_url
+        # The abstract is uninterpreted html code
+        strip_html(paper_site.css_first('.col > p:nth-child(8)').text()).strip(),
+        **urls
     )
 
 
+def strip_html(html: str) -> str:
+    """
+    Turn html code into its text by dropping the tags and unescaping the entities.
+    Like an html parser, a '<' which doesn't start a tag is kept, so inequalities survive.
+
+    >>> strip_html('<p>We &amp; they</p>')
+    'We & they'
+    >>> strip_html('0 < p < 1 and q > 2')
+    '0 < p < 1 and q > 2'
+    >>> strip_html('n<100 samples with m>5.')
+    'n<100 samples with m>5.'
+
+    :param html: The html code to strip.
+    :return: The text of the html code.
+    """
+    return unescape(HTML_TAGS.sub('', html))
+
+
+@lru_cache(maxsize=4096)
 def slugify(string: str, allow_unicode: bool = False) -> str:
     """
     Slugify a given string.
@@ -119,15 +158,222 @@ def slugify(string: str, allow_unicode: bool = False) -> str:
     else:
         # noinspection SpellCheckingInspection
         string = unicodedata.normalize('NFKD', string).encode('ascii', 'ignore').decode('ascii')
-    string = re.sub(r'[^\w\s-]', '', string).strip()
-    return re.sub(r'[-\s]+', '-', string)
+    return SLUG_SEPARATORS.sub('-', SLUG_INVALID_CHARS.sub('', string).strip())
+
+
+async def fetch_file(session: ClientSession, url: str, path: Path):
+    """
+    Fetch a file and store it on disk.
+    :param session: The session to fetch the file with.
+    :param url: The url of the file.
+    :param path: The path to store the file at.
+    """
+    loop = get_running_loop()
+    async with session.get(url) as response:
+        response.raise_for_status()
+        with open(path, 'wb', buffering=1 << 20) as f:
+            # Stream instead of holding whole supplemental archives in memory; the file buffer coalesces small chunks
+            async for chunk in response.content.iter_chunked(1 << 20):
+                await loop.run_in_executor(None, f.write, chunk)
+
+
+async def fetch_review(session: ClientSession, url: str, path: Path):
+    """
+    Fetch a review page and store its text on disk.
+    :param session: The session to fetch the review with.
+    :param url: The url of the review page.
+    :param path: The path to store the review text at.
+    """
+    async with session.get(url) as response:
+        response.raise_for_status()
+        review_html = LexborHTMLParser(await response.text())
+    review = review_html.css_first('body > p')
+    if review is None:
+        raise ValueError("Review page has no 'body > p' paragraph")
+    await get_running_loop().run_in_executor(None, path.write_text, review.text())
+
+
+async def download(fetch: Callable[[ClientSession, str, Path], Awaitable[None]], session: ClientSession, url: str,
+                   path: Path) -> bool:
+    """
+    Download a url to disk without letting a failure abort the remaining downloads.
+    Connection errors, timeouts and server errors are retried with an exponential backoff.
+    Unexpected page contents, reported by the fetch function as a ValueError, fail the download right away.
+    :param fetch: The function fetching the url and storing it.
+    :param session: The session to download with.
+    :param url: The url to download.
+    :param path: The path to store the download at.
+    :return: Whether the download succeeded.
+    """
+    for attempt in range(DOWNLOAD_RETRIES + 1):
+        try:
+            await fetch(session, url, path)
+            return True
+        except (ClientError, TimeoutError) as e:
+            error = e
+            if isinstance(e, ClientResponseError) and e.status < 500:
+                break  # Client errors won't go away by asking again
+        except ValueError as e:
+            error = e
+            break  # The page arrived but doesn't hold what we expect, asking again won't change that
+        if attempt < DOWNLOAD_RETRIES:
+            await sleep(DOWNLOAD_BACKOFF * 2 ** attempt)
+    print(f"    !!! Failed to download {url} ({type(error).__name__}: {error}) !!!!")
+    path.unlink(missing_ok=True)  # Don't leave a partial file behind
+    return False
+
+
+def extract_supplemental(supplemental: Path):
+    """
+    Unzip the supplemental material of a paper next to it and remove the zip file.
+    :param supplemental: The path of the zipped supplemental material.
+    """
+    extraction_path = Path(supplemental.parent, 'Supplemental')
+    extraction_path.mkdir(parents=True, exist_ok=True)
+    root = extraction_path.resolve()
+    try:
+        with ZipFile(supplemental, 'r') as f:
+            members = []
+            for info in f.infolist():
+                target = Path(root, info.filename).resolve()
+                if not target.is_relative_to(root):
+                    print(f"    !!! Skipping {info.filename} outside of {extraction_path} !!!!")
+                    continue
+                members.append((info, target))
+            # Create each directory once instead of once per member
+            for directory in {target if info.is_dir() else target.parent for info, target in members}:
+                directory.mkdir(parents=True, exist_ok=True)
+            for info, target in members:
+                if not info.is_dir():
+                    with f.open(info, 'r') as src, open(target, 'wb', buffering=1 << 20) as dst:
+                        copyfileobj(src, dst, length=1 << 20)
+        remove(supplemental)
+    except BadZipFile:
+        # https://papers.nips.cc/paper/2020/hash/95424358822e753eb993c97ee76a9076-Abstract.html
+        print(f"    !!! Failed to unzip faulty zip file {supplemental} !!!!")
+
+
+async def store_paper(semaphore: Semaphore, extractor: Executor, paper_entry: PaperEntry,
+                      downloads: List[Coroutine[Any, Any, bool]],
+                      supplemental: Optional[Path]) -> Tuple[int, Optional[str]]:
+    """
+    Run the downloads of a paper and unzip its supplemental material if necessary.
+    :param semaphore: The semaphore limiting how many papers are downloaded concurrently.
+    :param extractor: The executor to unzip the supplemental material in.
+    :param paper_entry: The entry of the paper to report once it is stored.
+    :param downloads: The pending downloads of the paper.
+    :param supplemental: The path of the supplemental material, if there is any.
+    :return: The number of failed downloads and the extension of the supplemental material, if it was downloaded.
+    """
+    async with semaphore:
+        failed = len(downloads) - sum(await gather(*downloads))
+    supplemental_ext = supplemental.suffix if supplemental is not None and supplemental.exists() else None
+    if supplemental_ext == '.zip':
+        # The semaphore is already released, so the next paper downloads while this one gets unzipped
+        await get_running_loop().run_in_executor(extractor, extract_supplemental, supplemental)
+    if failed:
+        print(f"Stored with {failed} failed downloads: {paper_entry}")
+    else:
+        print(f"Stored: {paper_entry}")
+    return failed, supplemental_ext
+
+
+async def scrape(browser: Browser, year: int):
+    """
+    Scrape all papers of a year and store them in the output directory.
+    :param browser: The browser to navigate the paper pages with.
+    :param year: The year to scrape.
+    """
+    no_author_feedback = 0
+    no_supplemental_material = 0
+    supplemental_material_zipped = 0
+    supplemental_material_pdf = 0
+    paper_entries = get_paper_entries(browser, year)
+    print(f"Fetching {len(paper_entries)} paper pages")
+    paper_pages = [browser.navigate(paper_entry.url.url).content for paper_entry in paper_entries]
+    print(f"Parsing {len(paper_pages)} paper pages")
+    with ProcessPoolExecutor() as parser:
+        papers = list(parser.map(parse_paper, paper_entries, paper_pages, chunksize=64))
+    semaphore = Semaphore(64)
+    with ThreadPoolExecutor(max_workers=4) as extractor:
+        tasks = []
+        async with ClientSession(
+                connector=TCPConnector(limit_per_host=8, keepalive_timeout=60),
+                # No total limit: it would include the time spent queueing for one of the few connections
+                timeout=ClientTimeout(total=None, sock_connect=30, sock_read=60),
+                headers={'User-Agent': browser.user_agent, 'Connection': browser.connection}
+        ) as session:
+            for paper in papers:
+                paper_entry = paper.paper_entry
+                paper_home = Path('out', str(year), slugify(paper_entry.title))
+                paper_home.mkdir(parents=True, exist_ok=True)
+
+                abstract = Path(paper_home, 'Abstract.txt')
+                with open(abstract, 'w') as f:
+                    f.write(paper.abstract)
+
+                authors = Path(paper_home, 'Authors.txt')
+                with open(authors, 'w') as f:
+                    f.write('\n'.join(paper_entry.authors))
+
+                downloads = []
+                # Exactly two papers (2020) don't have an author feedback:
+                # https://papers.nips.cc/paper/2020/hash/7ac52e3f2729d1b3f6d2b7e8f6467226-Abstract.html
+                # https://papers.nips.cc/paper/2020/hash/d6f1dd034aabde7657e6680444ceff62-Abstract.html
+                if paper.author_feedback_url is not None:
+                    assert (paper.author_feedback_url.endswith('.pdf'))
+                    author_feedback = Path(paper_home, 'AuthorFeedback.pdf')
+                    downloads.append(download(fetch_file, session, paper.author_feedback_url, author_feedback))
+                else:
+                    no_author_feedback += 1
+
+                assert (paper.bibtex_url.endswith('.bib'))
+                bibtex = Path(paper_home, 'Bibtex.bib')
+                downloads.append(download(fetch_file, session, paper.bibtex_url, bibtex))
+
+                assert (paper.meta_review_url.endswith('.html'))
+                meta_review = Path(paper_home, 'MetaReview.html')
+                downloads.append(download(fetch_review, session, paper.meta_review_url, meta_review))
+
+                assert (paper.paper_url.endswith('.pdf'))
+                paper_pdf = Path(paper_home, 'Paper.pdf')
+                downloads.append(download(fetch_file, session, paper.paper_url, paper_pdf))
+
+                assert (paper.review_url.endswith('.html'))
+                review = Path(paper_home, 'Review.html')
+                downloads.append(download(fetch_review, session, paper.review_url, review))
+
+                supplemental = None
+                if paper.supplemental_url is not None:
+                    is_zip = paper.supplemental_url.endswith('.zip')
+                    assert (is_zip or paper.supplemental_url.endswith('.pdf'))
+                    ext = '.zip' if is_zip else '.pdf'
+                    supplemental = Path(paper_home, f'Supplemental{ext}')
+                    downloads.append(download(fetch_file, session, paper.supplemental_url, supplemental))
+                else:
+                    no_supplemental_material += 1  # No supplemental material
+                tasks.append(create_task(store_paper(semaphore, extractor, paper_entry, downloads, supplemental)))
+            failed_downloads = 0
+            # Only count the supplemental material which actually got downloaded
+            for failed, supplemental_ext in await gather(*tasks):
+                failed_downloads += failed
+                if supplemental_ext == '.zip':
+                    supplemental_material_zipped += 1
+                elif supplemental_ext == '.pdf':
+                    supplemental_material_pdf += 1
+    print(f"Papers without author feedback: {no_author_feedback}")
+    print(f"Papers without supplemental material: {no_supplemental_material}")
+    print(f"Papers with zipped supplemental material: {supplemental_material_zipped}")
+    print(f"Papers with pdfs as supplemental material: {supplemental_material_pdf}")
+    print(f"Failed downloads: {failed_downloads}")
 
 
 if __name__ == '__main__':
     year = 2020
     ff = Firefox()
     ff.request_timeout = timedelta(0, 0.2)
-    ff.adapter = FileCacheAdapter()
+    ff.adapter = GzipFileCacheAdapter()
+    ff.adapter.max_retries = Retry(total=3, backoff_factor=0.5)
 
     # # How many papers are there?
     # pprs = []
@@ -152,93 +398,4 @@ if __name__ == '__main__':
     # exit(0)
 
     # Scrape and store
-    no_author_feedback = 0
-    no_supplemental_material = 0
-    supplemental_material_zipped = 0
-    supplemental_material_pdf = 0
-    for paper_entry in get_paper_entries(ff, year):
-        print(f"Processing: {paper_entry}")
-        paper = get_paper(ff, paper_entry)
-        paper_home = Path('out', str(year), slugify(paper_entry.title))
-        paper_home.mkdir(parents=True, exist_ok=True)
-
-        print(f"    Saving Abstract")
-        abstract = Path(paper_home, 'Abstract.txt')
-        with open(abstract, 'w') as f:
-            f.write(paper.abstract)
-
-        print(f"    Writing Authors")
-        authors = Path(paper_home, 'Authors.txt')
-        with open(authors, 'w') as f:
-            f.write('\n'.join(paper_entry.authors))
-
-        # Exactly two papers (2020) don't have an author feedback:
-        # https://papers.nips.cc/paper/2020/hash/7ac52e3f2729d1b3f6d2b7e8f6467226-Abstract.html
-        # https://papers.nips.cc/paper/2020/hash/d6f1dd034aabde7657e6680444ceff62-Abstract.html
-        if paper.author_feedback_url is not None:
-            print(f"    Downloading Author Feedback")
-            _, ext = splitext(paper.author_feedback_url.path)
-            assert (ext == '.pdf')
-            author_feedback = Path(paper_home, 'AuthorFeedback.pdf')
-            with open(author_feedback, 'wb') as f:
-                f.write(ff.get(paper.author_feedback_url.url).content)
-        else:
-            no_author_feedback += 1
-
-        print(f"    Downloading Bibtex Entry")
-        _, ext = splitext(paper.bibtex_url.path)
-        assert (ext == '.bib')
-        bibtex = Path(paper_home, 'Bibtex.bib')
-        with open(bibtex, 'wb') as f:
-            f.write(ff.get(paper.bibtex_url.url).content)
-
-        print(f"    Downloading Meta Review")
-        _, ext = splitext(paper.meta_review_url.path)
-        assert (ext == '.html')
-        meta_review = Path(paper_home, 'MetaReview.html')
-        meta_review_html = BeautifulSoup(ff.get(paper.meta_review_url.url).text, features="html5lib")
-        with open(meta_review, 'w') as f:
-            f.write(meta_review_html.select_one('body > p').text)
-
-        print(f"    Downloading Paper")
-        _, ext = splitext(paper.paper_url.path)
-        assert (ext == '.pdf')
-        paper_pdf = Path(paper_home, 'Paper.pdf')
-        with open(paper_pdf, 'wb') as f:
-            f.write(ff.get(paper.paper_url.url).content)
-
-        print(f"    Downloading Review")
-        _, ext = splitext(paper.review_url.path)
-        assert (ext == '.html')
-        review = Path(paper_home, 'Review.html')
-        review_html = BeautifulSoup(ff.get(paper.review_url.url).text, features="html5lib")
-        with open(review, 'w') as f:
-            f.write(review_html.select_one('body > p').text)
-
-        if paper.supplemental_url is None:
-            no_supplemental_material += 1
-            continue  # No supplemental material
-        print(f"    Downloading Supplemental Material")
-        _, ext = splitext(paper.supplemental_url.path)
-        assert (ext in ('.pdf', '.zip'))
-        supplemental = Path(paper_home, f'Supplemental{ext}')
-        with open(supplemental, 'wb') as f:
-            f.write(ff.get(paper.supplemental_url.url).content)
-        if ext == '.zip':
-            supplemental_material_zipped += 1
-            print(f"        Unzipping...")
-            extraction_path = Path(paper_home, 'Supplemental')
-            extraction_path.mkdir(parents=True, exist_ok=True)
-            try:
-                with ZipFile(supplemental, 'r') as f:
-                    f.extractall(extraction_path)
-                remove(supplemental)
-            except BadZipFile:
-                # https://papers.nips.cc/paper/2020/hash/95424358822e753eb993c97ee76a9076-Abstract.html
-                print("        !!! Failed to unzip faulty zip file !!!!")
-        else:
-            supplemental_material_pdf += 1
-    print(f"Papers without author feedback: {no_author_feedback}")
-    print(f"Papers without supplemental material: {no_supplemental_material}")
-    print(f"Papers with zipped supplemental material: {supplemental_material_zipped}")
-    print(f"Papers with pdfs as supplemental material: {supplemental_material_pdf}")
+    run(scrape(ff, year))